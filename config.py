@@ -434,6 +434,10 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'forwarder_timeout'):
             agentConfig['forwarder_timeout'] = int(config.get('Main', 'forwarder_timeout'))
 
+        # Number of transactions the forwarder may flush in parallel
+        if config.has_option('Main', 'forwarder_flush_parallelism'):
+            agentConfig['forwarder_flush_parallelism'] = int(config.get('Main', 'forwarder_flush_parallelism'))
+
 
         # Extra checks.d path
         # the linux directory is set by default
@@ -17,7 +17,6 @@ import logging
 import os
 import signal
 import sys
-import time
 
 # project
 from utils.process import is_my_process
@@ -51,10 +50,16 @@ class AgentSupervisor(object):
                     # The parent waits on the child.
                     cls.child_pid = pid
                     while not cls.need_stop:
-                        cpid, status = os.waitpid(pid, os.WNOHANG)
-                        if (cpid, status) != (0, 0):
-                            break
-                        time.sleep(1)
+                        # Block until the child exits instead of polling
+                        # waitpid(WNOHANG) every second; SIGTERM interrupts
+                        # the wait (EINTR) so need_stop is still honored
+                        try:
+                            os.waitpid(pid, 0)
+                        except OSError as e:
+                            if e.errno == errno.EINTR:
+                                continue
+                            raise
+                        break
                     if parent_func is not None:
                         parent_func()
 
@@ -15,7 +15,7 @@ initialize_logging('forwarder')
 
 # stdlib
 import copy
-from datetime import timedelta
+from datetime import datetime, timedelta
 import logging
 import os
 from Queue import Full, Queue
@@ -34,7 +34,6 @@ try:
 except ImportError:
     # For the source install, pycurl might not be installed
     pycurl = None
-from tornado.escape import json_decode
 import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
@@ -69,6 +68,9 @@ DD_ENDPOINT = "dd_url"
 # Transactions
 TRANSACTION_FLUSH_INTERVAL = 5000  # Every 5 seconds
 
+# Maximum number of concurrent requests the shared HTTP client may have in flight
+MAX_SIMULTANEOUS_REQUESTS = 10
+
 # Watchdog settings
 WATCHDOG_INTERVAL_MULTIPLIER = 10  # 10x flush interval
 WATCHDOG_HIGH_ACTIVITY_THRESHOLD = 1000  # Threshold to detect pathological activity
@@ -86,6 +88,10 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
+# Maximum number of queued transactions, so many small messages cannot grow
+# the queue without limit while staying under the byte cap
+MAX_QUEUE_COUNT = 30000
+
 # Some responses should be rejected, rather than replayed. This list will be rejected.
 RESPONSES_TO_REJECT = [413, 400]
 
@@ -109,7 +115,11 @@ class EmitterThread(threading.Thread):
             (data, headers) = self.__queue.get()
             try:
                 self.__logger.debug('Emitter %r handling a packet', self.__name)
-                self.__emitter(data, self.__logger, self.__config)
+                # Decompression and decoding are CPU-bound, do them here
+                # rather than on the IOLoop thread which queued the packet
+                if headers and headers.get('Content-Encoding') == 'deflate':
+                    data = zlib.decompress(data)
+                self.__emitter(json.loads(data), self.__logger, self.__config)
             except Exception:
                 self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
 
@@ -145,10 +155,9 @@ class EmitterManager(object):
 
     def send(self, data, headers=None):
         if not self.emitterThreads:
-            return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
+            return
+        # Hand the raw payload over as-is: emitter threads take care of
+        # decompression and decoding so the IOLoop is never blocked on them
         for emitterThread in self.emitterThreads:
             logging.info('Queueing for emitter %r', emitterThread.name)
             emitterThread.enqueue(data, headers)
@@ -161,6 +170,7 @@ class AgentTransaction(Transaction):
     _emitter_manager = None
     _type = None
     _request_timeout = 20
+    _http_client = None
 
     @classmethod
     def set_application(cls, app):
@@ -183,11 +193,41 @@ class AgentTransaction(Transaction):
     def get_tr_manager(cls):
         return cls._trManager
 
+    @classmethod
+    def get_http_client(cls, use_curl):
+        """Return the shared AsyncHTTPClient instance.
+
+        The client is created once and then reused for every flush: recreating
+        it per transaction would throw away the connection cache and pay a new
+        TCP (and TLS) handshake for each payload sent to the same endpoint. """
+        if AgentTransaction._http_client is None:
+            if use_curl:
+                if pycurl is None:
+                    log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
+                else:
+                    log.debug("Using CurlAsyncHTTPClient")
+                    tornado.httpclient.AsyncHTTPClient.configure(
+                        "tornado.curl_httpclient.CurlAsyncHTTPClient",
+                        max_clients=MAX_SIMULTANEOUS_REQUESTS)
+            else:
+                log.debug("Using SimpleHTTPClient")
+            AgentTransaction._http_client = tornado.httpclient.AsyncHTTPClient()
+        return AgentTransaction._http_client
+
     def __init__(self, data, headers, msg_type=""):
         self._data = data
         self._headers = headers
         self._headers['DD-Forwarder-Version'] = get_version()
         self._msg_type = msg_type
+        self._url = None
+
+        # Remove headers that were passed by the emitter. Those don't apply
+        # anymore. Scrubbing them once here beats re-checking on every flush
+        # attempt of every copy of this transaction
+        for h in HEADERS_TO_REMOVE:
+            if h in self._headers:
+                del self._headers[h]
+                log.debug("Removing %s header.", h)
 
         # Call after data has been set (size is computed in Transaction's init)
         Transaction.__init__(self)
@@ -197,13 +237,18 @@ class AgentTransaction(Transaction):
             self._emitter_manager.send(data, headers)
 
         # Insert the transaction(s) in the Manager
-        for endpoint in self._endpoints:
-            for api_key in self._endpoints[endpoint]:
-                transaction = copy.copy(self)
-                transaction._endpoint = endpoint
-                transaction._api_key = api_key
-                self._trManager.append(transaction)
-                log.debug("Created transaction %d" % transaction.get_id())
+        targets = [(endpoint, api_key)
+                   for endpoint in self._endpoints
+                   for api_key in self._endpoints[endpoint]]
+        for i, (endpoint, api_key) in enumerate(targets):
+            # Only copy when fanning out to several endpoint/api key pairs:
+            # with a single endpoint (the common case) the instance itself is
+            # queued, instead of being a throwaway template for one copy
+            transaction = self if i == len(targets) - 1 else copy.copy(self)
+            transaction._endpoint = endpoint
+            transaction._api_key = api_key
+            self._trManager.append(transaction)
+            log.debug("Created transaction %d", transaction.get_id())
         self._trManager.flush()
 
     def __sizeof__(self):
@@ -226,20 +271,13 @@ class AgentTransaction(Transaction):
             'request_timeout': self._request_timeout,
         }
 
-        # Remove headers that were passed by the emitter. Those don't apply anymore
-        # This is pretty hacky though as it should be done in pycurl or curl or tornado
-        for h in HEADERS_TO_REMOVE:
-            if h in tornado_client_params['headers']:
-                del tornado_client_params['headers'][h]
-                log.debug("Removing {0} header.".format(h))
-
         force_use_curl = False
 
         if proxy_settings is not None:
             force_use_curl = True
             if pycurl is not None:
-                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                          proxy_settings['host'], proxy_settings['port']))
+                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s",
+                          proxy_settings['user'], proxy_settings['host'], proxy_settings['port'])
                 tornado_client_params['proxy_host'] = proxy_settings['host']
                 tornado_client_params['proxy_port'] = proxy_settings['port']
                 tornado_client_params['proxy_username'] = proxy_settings['user']
@@ -255,17 +293,13 @@ class AgentTransaction(Transaction):
 
         use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
 
-        if use_curl:
-            if pycurl is None:
-                log.error("dd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-            else:
-                log.debug("Using CurlAsyncHTTPClient")
-                tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-        else:
-            log.debug("Using SimpleHTTPClient")
-        http = tornado.httpclient.AsyncHTTPClient()
+        http = self.get_http_client(use_curl)
 
-        url = self.get_url(self._endpoint, self._api_key)
+        # The endpoint URL is deterministic for a given transaction, so only
+        # build it on the first attempt and reuse it on replays
+        if self._url is None:
+            self._url = self.get_url(self._endpoint, self._api_key)
+        url = self._url
         log.debug(
             u"Sending %s to endpoint %s at %s",
             self._type, self._endpoint, url
@@ -275,7 +309,7 @@ class AgentTransaction(Transaction):
 
     def on_response(self, response):
         if response.error:
-            log.error("Response: %s" % response)
+            log.error("Response: %s", response)
             if response.code in RESPONSES_TO_REJECT:
                 self._trManager.tr_error_reject_request(self)
             else:
@@ -319,7 +353,8 @@ class StatusHandler(tornado.web.RequestHandler):
         transactions = m.get_transactions()
         for tr in transactions:
             self.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" %
-                (tr.get_id(), tr.get_size(), tr.get_error_count(), tr.get_next_flush()))
+                (tr.get_id(), tr.get_size(), tr.get_error_count(),
+                 datetime.utcfromtimestamp(tr.get_next_flush())))
         self.write("</table>")
 
         if threshold >= 0:
@@ -405,14 +440,17 @@ class Application(tornado.web.Application):
             log.warning(u"No valid endpoint found. Forwarder will drop all incoming payloads.")
         AgentTransaction.set_request_timeout(agentConfig['forwarder_timeout'])
 
-        max_parallelism = self.NO_PARALLELISM
-        # Multiple endpoints => enable parallelism
-        if len(agentConfig['endpoints']) > 1:
-            max_parallelism = self.DEFAULT_PARALLELISM
+        # Flushing serially bounds throughput by a single in-flight request;
+        # with the shared keep-alive client several requests can be pipelined
+        max_parallelism = self.DEFAULT_PARALLELISM
+        if agentConfig.get('forwarder_flush_parallelism') is not None:
+            max_parallelism = max(self.NO_PARALLELISM,
+                                  int(agentConfig['forwarder_flush_parallelism']))
 
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
                                               MAX_QUEUE_SIZE, THROTTLING_DELAY,
-                                              max_parallelism=max_parallelism)
+                                              max_parallelism=max_parallelism,
+                                              max_queue_count=MAX_QUEUE_COUNT)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -517,7 +555,7 @@ class Application(tornado.web.Application):
             log.exception("Uncaught exception. Forwarder is exiting.")
             sys.exit(1)
 
-        log.info("Listening on port %d" % self._port)
+        log.info("Listening on port %d", self._port)
 
         # Register callbacks
         self.mloop = tornado.ioloop.IOLoop.current()
@@ -536,7 +574,7 @@ class Application(tornado.web.Application):
         # Register optional Graphite listener
         gport = self._agentConfig.get("graphite_listen_port", None)
         if gport is not None:
-            log.info("Starting graphite listener on port %s" % gport)
+            log.info("Starting graphite listener on port %s", gport)
             from graphite import GraphiteServer
             gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
             if non_local_traffic is True:
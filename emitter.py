@@ -76,7 +76,7 @@ def http_emitter(message, log, agentConfig, endpoint):
     "Send payload"
     url = agentConfig['dd_url']
 
-    log.debug('http_emitter: attempting postback to ' + url)
+    log.debug('http_emitter: attempting postback to %s', url)
 
     # Post back the data
     try:
@@ -104,8 +104,8 @@ def http_emitter(message, log, agentConfig, endpoint):
 
     zipped = zlib.compress(payload)
 
-    log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
-              % (len(payload), len(zipped), float(len(payload))/float(len(zipped))))
+    log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f",
+              len(payload), len(zipped), float(len(payload))/float(len(zipped)))
 
     apiKey = message.get('apiKey', None)
     if not apiKey:
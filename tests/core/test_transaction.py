@@ -116,6 +116,29 @@ class TestTransaction(unittest.TestCase):
         trManager.flush()
         self.assertEqual(len(trManager._transactions), 0)
 
+    def testCountLimit(self):
+        """Test the max queue count limit"""
+
+        # No throttling, no delay for replay, cap the queue at 5 transactions
+        step = 5
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_endpoint_errors=100,
+                                       max_queue_count=step)
+
+        for i in xrange(step):
+            trManager.append(memTransaction(10, trManager))
+
+        trManager.flush()
+        self.assertEqual(len(trManager._transactions), step)
+
+        # Try to add one more
+        trManager.append(memTransaction(10, trManager))
+
+        # At this point, transaction one (the oldest) should have been removed from the list
+        self.assertEqual(len(trManager._transactions), step)
+        for tr in trManager._transactions:
+            self.assertNotEqual(tr._id, 1)
+
     def testThrottling(self):
         """Test throttling while flushing"""
 
@@ -3,7 +3,8 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
-from datetime import datetime, timedelta
+from datetime import datetime
+import itertools
 import logging
 from operator import attrgetter
 import sys
@@ -27,7 +28,7 @@ class Transaction(object):
 
         self._id = None
         self._error_count = 0
-        self._next_flush = datetime.utcnow()
+        self._next_flush = time.time()
         self._size = None
 
     def get_id(self):
@@ -55,14 +56,17 @@ class Transaction(object):
     def compute_next_flush(self,max_delay):
         # Transactions are replayed, try to send them faster for newer transactions
         # Send them every MAX_WAIT_FOR_REPLAY at most
-        td = timedelta(seconds=self._error_count * 20)
-        if td > max_delay:
-            td = max_delay
+        delay = min(self._error_count * 20, max_delay)
 
-        newdate = datetime.utcnow() + td
-        self._next_flush = newdate.replace(microsecond=0)
+        # Timestamps are plain epoch floats: cheaper than datetime objects
+        # on a path walked for every queued transaction
+        self._next_flush = int(time.time() + delay)
 
-    def time_to_flush(self,now = datetime.utcnow()):
+    def time_to_flush(self, now=None):
+        # The default must be resolved at call time: a default argument would
+        # be evaluated once at import and compare against a frozen timestamp
+        if now is None:
+            now = time.time()
         return self._next_flush <= now
 
     def flush(self):
@@ -73,13 +77,15 @@ class TransactionManager(object):
        are all commited, without exceeding parameters (throttling, memory consumption) """
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
-                 max_parallelism=1, max_endpoint_errors=4):
-        self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
+                 max_parallelism=1, max_endpoint_errors=4, max_queue_count=None):
+        # Delays are kept as plain float seconds internally, see Transaction
+        self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay.total_seconds()
         self._MAX_QUEUE_SIZE = max_queue_size
-        self._THROTTLING_DELAY = throttling_delay
+        self._MAX_QUEUE_COUNT = max_queue_count
+        self._THROTTLING_DELAY = throttling_delay.total_seconds()
         self._MAX_PARALLELISM = max_parallelism
         self._MAX_ENDPOINT_ERRORS = max_endpoint_errors
-        self._MAX_FLUSH_DURATION = timedelta(seconds=10)
+        self._MAX_FLUSH_DURATION = 10
 
         self._flush_without_ioloop = False # useful for tests
 
@@ -94,11 +100,12 @@ class TransactionManager(object):
         self._transactions_rejected = 0
 
         # Global counter to assign a number to each transaction: we may have an issue
-        #  if this overlaps
-        self._counter = 0
+        #  if this overlaps. itertools.count increments in C, without the
+        #  read-modify-write of a Python-level counter
+        self._counter = itertools.count(1)
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.utcnow() # Last flush (for throttling)
+        self._last_flush = time.time() # Last flush (for throttling)
 
         # Error management
         self._endpoints_errors = {}
@@ -111,12 +118,21 @@ class TransactionManager(object):
         return self._transactions
 
     def print_queue_stats(self):
-        log.debug("Queue size: at %s, %s transaction(s), %s KB" %
-            (time.time(), self._total_count, (self._total_size/1024)))
+        log.debug("Queue size: at %s, %s transaction(s), %s KB",
+            time.time(), self._total_count, self._total_size/1024)
 
     def get_tr_id(self):
-        self._counter = self._counter + 1
-        return self._counter
+        return next(self._counter)
+
+    def _is_over_capacity(self, tr_size):
+        """Would adding a transaction of tr_size bytes exceed the queue limits?
+
+        The byte cap alone does not bound the queue: many small transactions
+        can keep it under _MAX_QUEUE_SIZE while growing it without limit. """
+        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+            return True
+        return (self._MAX_QUEUE_COUNT is not None and
+                (self._total_count + 1) > self._MAX_QUEUE_COUNT)
 
     def append(self,tr):
 
@@ -126,18 +142,25 @@ class TransactionManager(object):
         # Check the size
         tr_size = tr.get_size()
 
-        log.debug("New transaction to add, total size of queue would be: %s KB" %
-            ((self._total_size + tr_size) / 1024))
+        log.debug("New transaction to add, total size of queue would be: %s KB",
+            (self._total_size + tr_size) / 1024)
 
-        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+        if self._is_over_capacity(tr_size):
             log.warn("Queue is too big, removing old transactions...")
             new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
+            # Collect the evicted transactions and rebuild the queue in one
+            # pass instead of one O(n) list.remove per eviction
+            evicted = set()
             for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+                if not self._is_over_capacity(tr_size):
+                    break
+                evicted.add(tr2)
+                self._total_count = self._total_count - 1
+                self._total_size = self._total_size - tr2.get_size()
+                log.warn("Removed transaction %s from queue", tr2.get_id())
+            if evicted:
+                self._transactions = [tr2 for tr2 in self._transactions
+                                      if tr2 not in evicted]
 
         # Done
         self._transactions.append(tr)
@@ -145,7 +168,7 @@ class TransactionManager(object):
         self._transactions_received += 1
         self._total_size = self._total_size + tr_size
 
-        log.debug("Transaction %s added" % (tr.get_id()))
+        log.debug("Transaction %s added", tr.get_id())
         self.print_queue_stats()
 
     def flush(self):
@@ -154,36 +177,35 @@ class TransactionManager(object):
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
         # Do we have something to do ?
-        now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        # Compare _next_flush directly: a method call per queued transaction
+        # is measurable when this scan runs every 5s over a large backlog
+        now = time.time()
+        to_flush = [tr for tr in self._transactions if tr._next_flush <= now]
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
         if count > 0:
             if should_log:
-                log.info("Flushing %s transaction%s during flush #%s" % (count,plural(count), str(self._flush_count + 1)))
+                log.info("Flushing %s transaction%s during flush #%s", count, plural(count), self._flush_count + 1)
             else:
-                log.debug("Flushing %s transaction%s during flush #%s" % (count,plural(count), str(self._flush_count + 1)))
+                log.debug("Flushing %s transaction%s during flush #%s", count, plural(count), self._flush_count + 1)
 
             self._endpoints_errors = {}
             self._finished_flushes = 0
 
             # We sort LIFO-style, taking into account errors
             self._trs_to_flush = sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
-            self._flush_time = datetime.utcnow()
+            self._flush_time = time.time()
             self.flush_next()
         else:
             if should_log:
-                log.info("No transaction to flush during flush #%s" % str(self._flush_count + 1))
+                log.info("No transaction to flush during flush #%s", self._flush_count + 1)
             else:
-                log.debug("No transaction to flush during flush #%s" % str(self._flush_count + 1))
+                log.debug("No transaction to flush during flush #%s", self._flush_count + 1)
 
         if self._flush_count + 1 == FLUSH_LOGGING_INITIAL:
-            log.info("First flushes done, next flushes will be logged every %s flushes." % FLUSH_LOGGING_PERIOD)
+            log.info("First flushes done, next flushes will be logged every %s flushes.", FLUSH_LOGGING_PERIOD)
 
         self._flush_count += 1
 
@@ -199,18 +221,17 @@ class TransactionManager(object):
 
         if self._trs_to_flush is not None and len(self._trs_to_flush) > 0:
             # Running for too long?
-            if datetime.utcnow() - self._flush_time >= self._MAX_FLUSH_DURATION:
+            if time.time() - self._flush_time >= self._MAX_FLUSH_DURATION:
                 log.warn('Flush %s is taking more than 10s, stopping it', self._flush_count)
                 self._trs_to_flush = []
                 return self.flush_next()
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            delay = td.total_seconds()
+            delay = self._last_flush + self._THROTTLING_DELAY - time.time()
 
             if delay <= 0 and self._running_flushes < self._MAX_PARALLELISM:
                 tr = self._trs_to_flush.pop()
                 self._running_flushes += 1
-                self._last_flush = datetime.utcnow()
+                self._last_flush = time.time()
                 log.debug("Flushing transaction %d", tr.get_id())
                 try:
                     tr.flush()
@@ -225,8 +246,10 @@ class TransactionManager(object):
                 # Wait a little bit more
                 tornado_ioloop = ioloop.IOLoop.current()
                 if tornado_ioloop._running:
+                    # Pass the bound method directly, no need to allocate a
+                    # wrapping lambda for every rescheduled flush
                     tornado_ioloop.add_timeout(time.time() + delay,
-                                               lambda: self.flush_next())
+                                               self.flush_next)
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
@@ -238,7 +261,7 @@ class TransactionManager(object):
             self._trs_to_flush = None
             log.debug('Flush %s took %ss (%s transactions)',
                       self._flush_count,
-                      (datetime.utcnow() - self._flush_time).total_seconds(),
+                      time.time() - self._flush_time,
                       self._finished_flushes)
         else:
             log.debug("Flush in progress, %s flushes running", self._running_flushes)
@@ -252,7 +275,7 @@ class TransactionManager(object):
                  tr.get_id(),
                  tr.get_error_count(),
                  plural(tr.get_error_count()),
-                 tr.get_next_flush())
+                 datetime.utcfromtimestamp(tr.get_next_flush()))
         self._endpoints_errors[tr._endpoint] = self._endpoints_errors.get(tr._endpoint, 0) + 1
         # Endpoint failed too many times, it's probably an enpoint issue
         # Let's avoid blocking on it